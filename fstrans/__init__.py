@@ -13,11 +13,17 @@ is raised inside transaction.
 """
 import os
 import os.path
-import select
-import time
 import sys
+import errno
+import stat
+import fcntl
+import time
 import logging
-from tempfile import mkdtemp
+import select
+import ctypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp, mkstemp, TemporaryFile
 import shutil
 
 TIMEOUT = 30
@@ -25,24 +31,345 @@ TIMEOUT = 30
 #
 # Atomic directory updates
 #
-def copy_tree(old, new):
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY
+# ioctl request to clone file data, from linux/fs.h. None on other
+# systems, where this number means nothing or something else
+_FICLONE = getattr(fcntl, "FICLONE",
+                   0x40049409 if sys.platform.startswith("linux") else None)
+# Thread pool size for parallel copy_tree
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Minimal number of first-level subdirectories to copy tree in parallel
+PARALLEL_THRESHOLD = 8
+# Number of hardlinks created by one task of parallel copy_tree
+LINK_BATCH = 64
+# Thread pool size for parallel clonetree
+CLONE_WORKERS = 8
+# Minimal number of files to clone in parallel
+CLONE_THRESHOLD = 32
+
+def _scan_dir(src_fd):
+    """
+    Reads directory open as src_fd. Returns list of (name, mode)
+    pairs for subdirectories, list of names of regular files and
+    list of names of other entries (symlinks, devices etc).
+    """
+    dirs = []
+    files = []
+    others = []
+    with os.scandir(src_fd) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append((entry.name,
+                             entry.stat(follow_symlinks=False).st_mode))
+            elif entry.is_file(follow_symlinks=False):
+                files.append(entry.name)
+            else:
+                others.append(entry.name)
+    return dirs, files, others
+
+def _py_link_names(src_fd, dst_fd, names):
+    """
+    Hardlinks given names from directory src_fd to directory dst_fd
+    """
+    for name in names:
+        os.link(name, name, src_dir_fd=src_fd, dst_dir_fd=dst_fd,
+                follow_symlinks=False)
+
+_link_names = _py_link_names
+try:
+    # Same loop in C, if extension is built
+    from fstrans._linktree import linktree as _link_names
+except ImportError:
+    pass
+
+# Errors meaning that particular file cannot be reflinked with all its
+# metadata, even though filesystem supports reflinks (e.g. btrfs
+# nodatacow files, files of other users, privileged xattrs)
+_REFLINK_FALLBACK_ERRORS = (errno.EINVAL, errno.EOPNOTSUPP, errno.EXDEV,
+                            errno.EPERM, errno.EACCES)
+
+def _copy_xattrs(src_fd, dst_fd):
+    """
+    Makes extended attributes (including POSIX ACLs and security
+    labels) of file dst_fd same as of file src_fd. Unlike
+    shutil.copystat, raises OSError if some of them cannot be set.
+    """
+    try:
+        names = os.listxattr(src_fd)
+    except OSError as err:
+        # Filesystem doesn't support them, so there is nothing to copy
+        if err.errno != errno.ENOTSUP:
+            raise
+        return
+    for name in set(os.listxattr(dst_fd)).difference(names):
+        # Inherited from directory, but original doesn't have it
+        os.removexattr(dst_fd, name)
+    for name in names:
+        os.setxattr(dst_fd, name, os.getxattr(src_fd, name))
+
+def _reflink_file(src_fd, dst_fd, name):
+    """
+    Creates in directory dst_fd copy of regular file name from
+    directory src_fd, which shares data blocks with original
+    (FICLONE ioctl). Owner, extended attributes, permissions and
+    times are preserved. Raises OSError if some of them cannot be.
+    """
+    infd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=src_fd)
+    try:
+        st = os.fstat(infd)
+        outfd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                        0o600, dir_fd=dst_fd)
+        try:
+            fcntl.ioctl(outfd, _FICLONE, infd)
+            new_st = os.fstat(outfd)
+            if (new_st.st_uid, new_st.st_gid) != (st.st_uid, st.st_gid):
+                # Fails with EPERM unless process is privileged
+                os.fchown(outfd, st.st_uid, st.st_gid)
+            # Before chmod, which may make file read-only
+            _copy_xattrs(infd, outfd)
+            os.chmod(outfd, stat.S_IMODE(st.st_mode))
+            os.utime(outfd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+def _reflink_names(src_fd, dst_fd, names):
+    """
+    Creates in directory dst_fd reflinked copies of given regular
+    files from directory src_fd. Files which cannot be reflinked
+    with all their metadata are hardlinked instead.
+    """
+    for name in names:
+        try:
+            _reflink_file(src_fd, dst_fd, name)
+        except OSError as err:
+            if err.errno not in _REFLINK_FALLBACK_ERRORS:
+                raise
+            try:
+                os.unlink(name, dir_fd=dst_fd)
+            except FileNotFoundError:
+                pass
+            os.link(name, name, src_dir_fd=src_fd, dst_dir_fd=dst_fd,
+                    follow_symlinks=False)
+
+# Results of _can_reflink by st_dev of filesystem
+_REFLINK_SUPPORT = {}
+
+def _can_reflink(dirname):
+    """
+    Checks if filesystem of given directory supports FICLONE ioctl.
+    Filesystem is probed only once, result is cached by its st_dev
+    """
+    if _FICLONE is None:
+        return False
+    dev = os.stat(dirname).st_dev
+    if dev not in _REFLINK_SUPPORT:
+        try:
+            with TemporaryFile(dir=dirname) as src:
+                with TemporaryFile(dir=dirname) as dst:
+                    fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            _REFLINK_SUPPORT[dev] = True
+        except OSError:
+            _REFLINK_SUPPORT[dev] = False
+    return _REFLINK_SUPPORT[dev]
+
+# Errors of copy_file_range meaning that it cannot be used for given files
+_COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                         errno.EOPNOTSUPP)
+
+def _fast_copy(src, dst):
+    """
+    Copies content of file src into file dst. Tries to clone
+    data blocks (FICLONE, Linux only), then to copy inside kernel
+    (copy_file_range) and falls back to copying via userspace buffer.
+    """
+    with open(src, "rb") as infile, open(dst, "wb") as outfile:
+        infd = infile.fileno()
+        outfd = outfile.fileno()
+        if _FICLONE is not None:
+            try:
+                fcntl.ioctl(outfd, _FICLONE, infd)
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            size = max(os.fstat(infd).st_size, 1 << 20)
+            try:
+                while os.copy_file_range(infd, outfd, size) > 0:
+                    pass
+                return
+            except OSError as err:
+                if err.errno not in _COPY_FALLBACK_ERRORS:
+                    raise
+        # Continues from wherever copy_file_range has stopped
+        shutil.copyfileobj(infile, outfile)
+
+def _unlink_and_copy(fullname, oldcopy):
+    """
+    Replaces hardlink fullname by private copy of file oldcopy
+    """
+    os.unlink(fullname)
+    _fast_copy(oldcopy, fullname)
+    shutil.copystat(oldcopy, fullname)
+
+def _shared_files(workdir, olddir):
+    """
+    Yields (working tree path, committed tree path) pairs for regular
+    files under directory workdir which are still hardlinked to
+    same files in olddir
+    """
+    with os.scandir(workdir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _shared_files(entry.path,
+                                         os.path.join(olddir, entry.name))
+            elif (entry.is_file(follow_symlinks=False) and
+                  entry.stat(follow_symlinks=False).st_nlink != 1):
+                yield (entry.path, os.path.join(olddir, entry.name))
+
+def _copy_subdir(src_fd, dst_fd, name, mode, copy_files):
+    """
+    Creates subdirectory name in directory dst_fd and copies
+    into it contents of same subdirectory of src_fd
+    """
+    os.mkdir(name, mode, dir_fd=dst_fd)
+    sub_src = os.open(name, _DIR_FLAGS, dir_fd=src_fd)
+    try:
+        sub_dst = os.open(name, _DIR_FLAGS, dir_fd=dst_fd)
+        try:
+            _copy_tree_at(sub_src, sub_dst, copy_files)
+        finally:
+            os.close(sub_dst)
+    finally:
+        os.close(sub_src)
+
+def _copy_tree_at(src_fd, dst_fd, copy_files, parallel=False):
+    """
+    Populates directory open as dst_fd with copies of files of
+    directory open as src_fd, recursing into subdirectories.
+    Regular files are copied by copy_files function (either
+    _link_names or _reflink_names), everything else is hardlinked.
+
+    All names are resolved relative to directory file descriptors,
+    so kernel doesn't have to walk full path for each file.
+
+    If parallel is true and there are enough subdirectories,
+    they are copied by thread pool, as well as batches of files.
+    """
+    dirs, files, others = _scan_dir(src_fd)
+    if parallel and len(dirs) >= PARALLEL_THRESHOLD:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(_copy_subdir, src_fd, dst_fd,
+                                       name, mode, copy_files)
+                       for (name, mode) in dirs]
+            futures += [executor.submit(copy_files, src_fd, dst_fd,
+                                        files[i:i + LINK_BATCH])
+                        for i in range(0, len(files), LINK_BATCH)]
+            futures += [executor.submit(_link_names, src_fd, dst_fd,
+                                        others[i:i + LINK_BATCH])
+                        for i in range(0, len(others), LINK_BATCH)]
+            for future in futures:
+                future.result()
+        return
+    copy_files(src_fd, dst_fd, files)
+    _link_names(src_fd, dst_fd, others)
+    for (name, mode) in dirs:
+        _copy_subdir(src_fd, dst_fd, name, mode, copy_files)
+
+def copy_tree(old, new, reflink=False):
     """
     Creates new directory tree similar to old one by creating
     directories and hardlinking files.
-    If top of new tree exists, rises FileExistsError
+    If top of new tree exists, rises FileExistsError. If copying
+    fails otherwise, partially created new tree is removed.
+
+    If reflink is true and filesystem supports it (btrfs, XFS),
+    regular files are copied as reflinks instead of hardlinks,
+    so they are independent from originals but share their data
+    blocks until modified.
     """
     old = os.path.abspath(old)
     new = os.path.abspath(new)
     os.mkdir(new, 0o755)
-    os.chmod(new, os.stat(old).st_mode)
-    for (root, _, files) in os.walk(old):
-        newdir = new + root[len(old):]
-        if newdir != new:
-            os.mkdir(newdir, os.stat(root).st_mode)
-        for f in files: #pylint: disable=invalid-name
-            os.link(os.path.join(root, f), os.path.join(newdir, f))
-
-class Transaction:
+    try:
+        copy_files = _link_names
+        if reflink and _can_reflink(new):
+            copy_files = _reflink_names
+        src_fd = os.open(old, _DIR_FLAGS)
+        try:
+            dst_fd = os.open(new, _DIR_FLAGS)
+            try:
+                _copy_tree_at(src_fd, dst_fd, copy_files, parallel=True)
+                os.chmod(dst_fd, os.stat(src_fd).st_mode)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    except BaseException:
+        # Partial copy is of no use, and for Transaction it is a lock
+        shutil.rmtree(new)
+        raise
+
+try:
+    _LIBC = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _LIBC = None
+# inotify event masks, from sys/inotify.h
+_IN_MOVED_FROM = 0x00000040
+_IN_DELETE = 0x00000200
+
+def _wait_removal(parent, name, timeout):
+    """
+    Waits up to timeout seconds until entry name is removed from
+    directory parent or renamed away, using inotify.
+    May return earlier if something else in parent is removed.
+    Returns False if inotify is not available.
+    """
+    inotify_init1 = getattr(_LIBC, "inotify_init1", None)
+    if inotify_init1 is None:
+        return False
+    ifd = inotify_init1(os.O_CLOEXEC)
+    if ifd < 0:
+        return False
+    try:
+        if _LIBC.inotify_add_watch(ifd, os.fsencode(parent),
+                                   _IN_DELETE | _IN_MOVED_FROM) < 0:
+            return False
+        # Entry could have gone before watch was added
+        if os.path.lexists(os.path.join(parent, name)):
+            # poll rather than select, which fails for fds >= FD_SETSIZE
+            poller = select.poll()
+            poller.register(ifd, select.POLLIN)
+            poller.poll(max(0, timeout) * 1000)
+        return True
+    finally:
+        os.close(ifd)
+
+# renameat2 arguments, from fcntl.h and linux/fs.h
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+def _exchange(path1, path2):
+    """
+    Atomically exchanges two existing directory entries using
+    renameat2 with RENAME_EXCHANGE flag.
+    Returns False if it is not supported by OS or filesystem.
+    """
+    renameat2 = getattr(_LIBC, "renameat2", None)
+    if renameat2 is None:
+        return False
+    if renameat2(_AT_FDCWD, os.fsencode(path1), _AT_FDCWD,
+                 os.fsencode(path2), _RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EINVAL, errno.ENOSYS):
+        return False
+    raise OSError(err, os.strerror(err), path1, None, path2)
+
+# Options and precomputed paths are kept as plain attributes, so
+# they are cheap to access in the middle of transaction
+class Transaction: #pylint: disable=too-many-instance-attributes
     """
     Atomic modification for directory tree.
     Creates working copy and lets modify it.
@@ -76,7 +403,8 @@ class Transaction:
     Transaction is commited if control leaves with block without error
     and rolled back if exception occur.
     """
-    def __init__(self, path, timeout=30, leave_snapshot=None):
+    def __init__(self, path, timeout=30, leave_snapshot=None, reflink=False,
+                 background_cleanup=False):
         """
         Initializes transaction object storing path to modify and
         some other properties.
@@ -89,6 +417,12 @@ class Transaction:
         leave_snapshot - if not none, strftime format,
                previous copy would be retained in the name with
                date of fishing modification formatted using this format
+        reflink - if true and filesystem supports it, working tree
+               is populated with reflinked copies instead of hardlinks,
+               so files can be modified in place without cloning
+        background_cleanup - if true, discarded version of tree is
+               removed by separate thread, so leaving transaction
+               context doesn't wait for it
         """
         if not os.path.isdir(path):
             raise ValueError("Not a directory")
@@ -96,8 +430,13 @@ class Transaction:
             raise ValueError("Snapshot name couldn't contain slashes")
         self.parent, self.commited = os.path.split(os.path.realpath(path))
         self.workdir = "." + self.commited
+        # parent is already resolved, so these are real paths too
+        self._old_path = os.path.join(self.parent, self.commited)
+        self._new_path = os.path.join(self.parent, self.workdir)
         self.timeout = timeout
         self.leave_snapshot = leave_snapshot
+        self.reflink = reflink
+        self.background_cleanup = background_cleanup
         self.opened = False
         self.cwd = None
 
@@ -108,31 +447,37 @@ class Transaction:
 
         If this tree exists assumes that directory is locked by another
         copy of same process and retries until TIMEOUT secound passes.
-        If it passes, raises TimeoutError. On first attempt to lock writes
-        message to stdout if lock unsuccessful
+        If it passes, raises TimeoutError. If first attempt to lock is
+        unsuccessful, logs warning, and one more when lock is acquired.
 
         If successefully starts transaction, returns self.
         """
-        tree = os.path.join(self.parent, self.commited)
+        tree = self._old_path
         msg = "directory %s already locked. Waiting" % tree
-        newtree = os.path.join(self.parent, self.workdir)
+        newtree = self._new_path
         finish = time.time() + self.timeout
         self.cwd = os.getcwd()
         log = None
+        delay = 0.05
         while time.time() < finish:
             try:
-                copy_tree(tree, newtree)
+                copy_tree(tree, newtree, self.reflink)
                 os.chdir(newtree)
                 if log:
                     log.warning("Successfully locked tree %s" % tree)
                 self.opened = True
                 return self
             except FileExistsError:
-                log = logging.getLogger("fstrans")
-                log.warning(msg)
-                msg = "."
-                # Wait for a while
-                select.select([sys.stdin], [], [sys.stdin], 0.5)
+                # Report waiting once, and then only success
+                if log is None:
+                    log = logging.getLogger("fstrans")
+                    log.warning(msg)
+                # Wait until lock is released. Without inotify
+                # wait for a while, doubling delay up to half a second
+                if not _wait_removal(self.parent, self.workdir,
+                                     finish - time.time()):
+                    time.sleep(max(0, min(delay, finish - time.time())))
+                    delay = min(delay * 2, 0.5)
         # We get here only if timeout expired
         raise TimeoutError("Cannot lock directory %s" % tree)
 
@@ -142,27 +487,58 @@ class Transaction:
         Unlocks tree by removing either old tree (and replacing it by
         temporary working tree) if normal exit from context occurs,
         or temporary tree if exception was raised.
+        If replacing old tree fails, it is left intact, temporary
+        tree is discarded and exception is propagated.
         """
         tempdir = mkdtemp(dir=self.parent)
         os.chdir(self.cwd)
         self.opened = False
         if exch_type is None:
             if self.leave_snapshot is not None:
-                os.rename(os.path.join(self.parent, self.commited),
-                          os.path.join(self.parent,
-                                       time.strftime(self.leave_snapshot)))
+                oldtree = os.path.join(self.parent,
+                                       time.strftime(self.leave_snapshot))
             else:
-                os.rename(os.path.join(self.parent, self.commited),
+                oldtree = os.path.join(tempdir, self.commited)
+            try:
+                self._replace(oldtree)
+            except BaseException:
+                # Committed tree is intact. Discard working tree,
+                # so it doesn't remain locked
+                os.rename(self._new_path,
                           os.path.join(tempdir, self.commited))
-            os.rename(os.path.join(self.parent, self.workdir),
-                      os.path.join(self.parent, self.commited))
+                shutil.rmtree(tempdir)
+                raise
         else:
-            os.rename(os.path.join(self.parent, self.workdir),
+            os.rename(self._new_path,
                       os.path.join(tempdir, self.commited))
-    # Remove temporary directory tree
-        shutil.rmtree(tempdir)
+        # Remove temporary directory tree
+        if self.background_cleanup:
+            # Non-daemon thread, so interpreter waits for it on exit
+            threading.Thread(target=shutil.rmtree, args=(tempdir,)).start()
+        else:
+            shutil.rmtree(tempdir)
         # Should return false for exception to be reraised
         return exch_type is None
+    def _replace(self, oldtree):
+        """
+        Replaces committed tree by working one, moving old version
+        to oldtree. If it fails, committed tree is left as it was.
+        """
+        if _exchange(self._new_path, self._old_path):
+            # Old version now has name of working tree, so
+            # lock is held until it is moved away
+            try:
+                os.rename(self._new_path, oldtree)
+            except BaseException:
+                _exchange(self._new_path, self._old_path)
+                raise
+        else:
+            os.rename(self._old_path, oldtree)
+            try:
+                os.rename(self._new_path, self._old_path)
+            except BaseException:
+                os.rename(oldtree, self._old_path)
+                raise
     def check_opened(self, should=True):
         """ Check for valid transaction state.
         By default, raises exception if transaction is closed
@@ -190,9 +566,7 @@ class Transaction:
 
         Otherwise it is directory which is passed to constructor
         """
-        if self.opened:
-            return os.path.join(self.parent, self.workdir)
-        return os.path.join(self.parent, self.commited)
+        return self._new_path if self.opened else self._old_path
 
     def open(self, name, mode='r', **kwargs):
         """
@@ -209,23 +583,30 @@ class Transaction:
             except FileNotFoundError:
                 pass
         elif '+' in mode or 'a' in mode:
-            # Need a copy
-            inf = open(fullname, "r")
-            os.unlink(fullname)
-            if "r" in mode:
-                # Need to touch file first
-                open(fullname, "w").close()
-            outf = open(fullname, mode)
-            shutil.copyfileobj(inf, outf)
-            inf.close()
-            if mode.startswith("r+"):
-                outf.seek(0, 0)
-            return outf
+            # Need a copy, unless file is not shared with original tree
+            try:
+                nlink = os.stat(fullname).st_nlink
+            except FileNotFoundError:
+                nlink = 1
+            if nlink > 1:
+                tmpfd, tmpname = mkstemp(dir=os.path.dirname(fullname))
+                os.close(tmpfd)
+                try:
+                    _fast_copy(fullname, tmpname)
+                    shutil.copystat(fullname, tmpname)
+                    os.replace(tmpname, fullname)
+                except BaseException:
+                    os.unlink(tmpname)
+                    raise
         return open(fullname, mode, **kwargs)
-    def putfile(self, dest, source):
+    def putfile(self, dest, source, move=False):
         """
         Puts file source which can be either inside or outside working
         tree to file dest, which should be inside working tree
+
+        If move is true, source is moved rather than copied, i.e.
+        renamed if it is on same filesystem and removed after copying
+        otherwise.
         """
         self.check_opened()
         fullname = self.check_inside(dest)
@@ -234,8 +615,17 @@ class Transaction:
         except FileNotFoundError:
             pass
         os.makedirs(os.path.dirname(fullname), exist_ok=True)
-        shutil.copyfile(source, fullname)
+        if move:
+            try:
+                os.replace(source, fullname)
+                return
+            except OSError as err:
+                if err.errno != errno.EXDEV:
+                    raise
+        _fast_copy(source, fullname)
         shutil.copystat(source, fullname)
+        if move:
+            os.unlink(source)
     def clonefile(self, path):
         """
         Prepares file in temporary transaction directory
@@ -246,19 +636,26 @@ class Transaction:
         if os.stat(fullname).st_nlink == 1:
             # Already cloned
             return
-        os.unlink(fullname)
-        prefixlen = len(os.path.join(self.parent, self.workdir))
-        oldcopy = (os.path.join(self.parent, self.commited) +
-                   fullname[prefixlen:])
-        shutil.copyfile(oldcopy, fullname)
-        shutil.copystat(oldcopy, fullname)
+        oldcopy = self._old_path + fullname[len(self._new_path):]
+        _unlink_and_copy(fullname, oldcopy)
     def clonetree(self, path):
         """
         Prepares entire directory in temporary transaction directory
-        for in-place modification
+        for in-place modification. If path is a file, clones it as
+        clonefile does. Does nothing if path doesn't exist.
         """
         self.check_opened()
         fullname = self.check_inside(path)
-        for (root, _, files) in os.walk(fullname):
-            for filename in files:
-                self.clonefile(os.path.join(root, filename))
+        if not os.path.isdir(fullname):
+            if os.path.exists(fullname):
+                self.clonefile(path)
+            return
+        olddir = self._old_path + fullname[len(self._new_path):]
+        targets = list(_shared_files(fullname, olddir))
+        if len(targets) < CLONE_THRESHOLD:
+            for (workfile, oldcopy) in targets:
+                _unlink_and_copy(workfile, oldcopy)
+            return
+        with ThreadPoolExecutor(max_workers=CLONE_WORKERS) as executor:
+            # Consume results to reraise exceptions from workers
+            list(executor.map(_unlink_and_copy, *zip(*targets)))
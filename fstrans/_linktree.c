@@ -0,0 +1,70 @@
+/*
+ * Fast path for fstrans.copy_tree.
+ *
+ * Hardlinks a batch of names from one directory to another with
+ * linkat(2), relative to directory file descriptors, without
+ * returning to the interpreter between files.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+static PyObject *
+linktree(PyObject *self, PyObject *args)
+{
+    int src_fd, dst_fd, rc, saved_errno;
+    PyObject *names, *seq, *name, *encoded;
+    Py_ssize_t i, count;
+
+    if (!PyArg_ParseTuple(args, "iiO:linktree", &src_fd, &dst_fd, &names))
+        return NULL;
+    seq = PySequence_Fast(names, "names must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    count = PySequence_Fast_GET_SIZE(seq);
+    for (i = 0; i < count; i++) {
+        name = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyUnicode_FSConverter(name, &encoded))
+            goto error;
+        Py_BEGIN_ALLOW_THREADS
+        rc = linkat(src_fd, PyBytes_AS_STRING(encoded),
+                    dst_fd, PyBytes_AS_STRING(encoded), 0);
+        saved_errno = errno;
+        Py_END_ALLOW_THREADS
+        /* Py_DECREF may free memory and clobber errno */
+        Py_DECREF(encoded);
+        if (rc != 0) {
+            errno = saved_errno;
+            PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, name);
+            goto error;
+        }
+    }
+    Py_DECREF(seq);
+    Py_RETURN_NONE;
+error:
+    Py_DECREF(seq);
+    return NULL;
+}
+
+static PyMethodDef linktree_methods[] = {
+    {"linktree", linktree, METH_VARARGS,
+     "linktree(src_fd, dst_fd, names)\n\n"
+     "Hardlinks given names from directory src_fd to directory dst_fd"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef linktree_module = {
+    PyModuleDef_HEAD_INIT,
+    "fstrans._linktree",
+    "Fast path for fstrans.copy_tree",
+    -1,
+    linktree_methods
+};
+
+PyMODINIT_FUNC
+PyInit__linktree(void)
+{
+    return PyModule_Create(&linktree_module);
+}
@@ -6,68 +6,204 @@ Test suite for fstrans module
 import unittest
 import os
 import os.path
-import shutil
-from fstrans import Transaction
+import tempfile
+import resource
+import threading
+import errno
+from contextlib import suppress, nullcontext
+from unittest import mock
+import fstrans
+from fstrans import (Transaction, copy_tree, PARALLEL_THRESHOLD,
+                     CLONE_THRESHOLD)
+try:
+    from concurrencytest import ConcurrentTestSuite, fork_for_tests
+except ImportError:
+    ConcurrentTestSuite = None
+
+# Where to create playground directories. Tmpfs is used if available
+# so tests don't touch block device.
+TEST_TMPDIR = os.environ.get("FSTRANS_TEST_TMPFS",
+                             "/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+# Contents of test files
+_ORIG = b"This is test file content\n"
+_NEW = b"This is changed content\n"
+_RPLUS = b"That is test file content\n"
+_APP = _ORIG + _NEW
+_UPD = b"This is updated file content\n"
+_OUTSIDE = b"This is file outside transaction\n"
+
+def fake_ficlone(fd, request, arg): #pylint: disable=invalid-name
+    """
+    Helper function - replacement for fcntl.ioctl which emulates
+    FICLONE by copying file data, for filesystems without reflinks
+    """
+    if request != fstrans._FICLONE: #pylint: disable=protected-access
+        raise OSError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+    os.lseek(arg, 0, os.SEEK_SET)
+    while True:
+        data = os.read(arg, 65536)
+        if not data:
+            return 0
+        os.write(fd, data)
 
 def getfile(filename):
     """
-    Helper function - returns content of given file
+    Helper function - returns content of given file as bytes
     """
-    with open(filename, "r") as f: #pylint: disable=invalid-name
-        return f.read()
+    #pylint: disable=invalid-name
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        return os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+_open, _write, _close = os.open, os.write, os.close
+_PUT_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
 def putfile(filename, content):
     """
-    Helper function - stores given string into given file
+    Helper function - stores given bytes or string into given file
+    with single write
     """
-    with open(filename, "w") as f: #pylint: disable=invalid-name
-
-        f.write(content)
+    #pylint: disable=invalid-name
+    fd = _open(filename, _PUT_FLAGS, 0o644)
+    try:
+        _write(fd, content if isinstance(content, bytes)
+               else content.encode())
+    finally:
+        _close(fd)
+def _fast_rmtree(path):
+    """
+    Helper function - removes directory tree. Whole tree is listed
+    first, and then removed in tight loop with locally bound functions
+    """
+    walk = list(os.walk(path, topdown=False))
+    _unlink, _rmdir, _join = os.unlink, os.rmdir, os.path.join
+    _islink = os.path.islink
+    for (root, dirs, files) in walk:
+        for name in files:
+            _unlink(_join(root, name))
+        for name in dirs:
+            # os.walk lists symlinks to directories among directories
+            fullname = _join(root, name)
+            if _islink(fullname):
+                _unlink(fullname)
+            else:
+                _rmdir(fullname)
+    _rmdir(path)
 class FsTransTestCase(unittest.TestCase):
     """
     Tests for fstrans module
     """
+    @classmethod
+    def setUpClass(cls):
+        """
+        Runs empty transaction once on throwaway tree, so first real
+        test doesn't pay for lazy initialization
+        """
+        scratch = tempfile.mkdtemp(prefix="fstrans-", dir=TEST_TMPDIR)
+        os.mkdir(os.path.join(scratch, "w"))
+        with Transaction(os.path.join(scratch, "w")):
+            pass
+        _fast_rmtree(scratch)
     def setUp(self):
         """
-        Test case setup - creates directory to play with
+        Test case setup - creates directory to play with and
+        workdir tree with testfile.txt inside it
         """
-        self.root = "testdata"
-        if os.path.isdir(self.root):
-            shutil.rmtree(self.root)
         self.cwd = os.getcwd()
-        os.mkdir(self.root)
+        self.root = tempfile.mkdtemp(prefix="fstrans-", dir=TEST_TMPDIR)
         os.chdir(self.root)
+        # Real path of playground and where Transaction should chdir to
+        self.root_abs = os.getcwd()
+        self.workdir_inside = os.path.join(self.root_abs, ".workdir")
+        # Tree to run transactions on
+        os.mkdir("workdir")
+        putfile("workdir/testfile.txt", _ORIG)
     def tearDown(self):
         """
         Test case teardown - removes playground directory
         """
         os.chdir(self.cwd)
-        shutil.rmtree(self.root)
+        _fast_rmtree(self.root)
+    def _assert_no_leftovers(self, *extras):
+        """
+        Checks that playground contains only workdir and given
+        extra entries, i.e. transaction left no temporary files
+        """
+        with os.scandir(".") as entries:
+            names = {entry.name for entry in entries}
+        self.assertEqual(names, {"workdir", *extras})
+    def test_lock_timeout(self):
+        """
+        Tests that Transaction raises TimeoutError if working
+        tree is held by someone else for too long
+        """
+        os.mkdir(".workdir")
+        with self.assertLogs("fstrans"):
+            with self.assertRaises(TimeoutError):
+                with Transaction("workdir", timeout=0.3):
+                    pass
+        self._assert_no_leftovers(".workdir")
+    def test_lock_wait(self):
+        """
+        Tests that Transaction waits for working tree to be released
+        by someone else and then proceeds
+        """
+        os.mkdir(".workdir")
+        timer = threading.Timer(0.2, os.rmdir, [os.path.abspath(".workdir")])
+        timer.start()
+        try:
+            with self.assertLogs("fstrans"):
+                with Transaction("workdir", timeout=5) as txn:
+                    self.assertTrue(txn.opened)
+        finally:
+            timer.join()
+        self._assert_no_leftovers()
+    def test_lock_wait_high_fd(self):
+        """
+        Tests that waiting for lock works when inotify descriptor
+        gets number above select() limit
+        """
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < 1200 and (hard == resource.RLIM_INFINITY or
+                                hard >= 1200):
+                resource.setrlimit(resource.RLIMIT_NOFILE, (1200, hard))
+                self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE,
+                                (soft, hard))
+        except (ValueError, OSError):
+            pass
+        fd = -1 #pylint: disable=invalid-name
+        while fd < 1100:
+            try:
+                fd = os.open(".", os.O_RDONLY) #pylint: disable=invalid-name
+            except OSError:
+                self.skipTest("Cannot open enough file descriptors")
+            self.addCleanup(os.close, fd)
+        os.mkdir(".workdir")
+        with self.assertLogs("fstrans"):
+            with self.assertRaises(TimeoutError):
+                with Transaction("workdir", timeout=0.3):
+                    pass
     def test_curdir_commit(self):
         """
         Tests if Transaction changes directory into top of working
         tree and restores on commit
         """
-        olddir = os.getcwd()
-        os.mkdir("workdir")
         with Transaction("workdir"):
-            self.assertEqual(os.getcwd(), os.path.join(olddir, ".workdir"))
-        self.assertEqual(os.getcwd(), olddir)
-        self.assertEqual(os.listdir("."), ["workdir"])
+            self.assertEqual(os.getcwd(), self.workdir_inside)
+        self.assertEqual(os.getcwd(), self.root_abs)
+        self._assert_no_leftovers()
     def test_curdir_rollback(self):
         """
         Tests if Transaction changes directory into top of working
         tree and restores on rollback
         """
-        olddir = os.getcwd()
-        os.mkdir("workdir")
-        try:
-            with Transaction("workdir"):
-                self.assertEqual(os.getcwd(), os.path.join(olddir, ".workdir"))
-                raise RuntimeError("Aborting Transaction")
-        except RuntimeError:
-            pass
-        self.assertEqual(os.getcwd(), olddir)
-        self.assertEqual(os.listdir("."), ["workdir"])
+        with suppress(RuntimeError), Transaction("workdir"):
+            self.assertEqual(os.getcwd(), self.workdir_inside)
+            raise RuntimeError("Aborting Transaction")
+        self.assertEqual(os.getcwd(), self.root_abs)
+        self._assert_no_leftovers()
     def test_commit(self):
         """"
         Create test directory, create file in it
@@ -76,16 +212,13 @@ class FsTransTestCase(unittest.TestCase):
         Commit. See file changed
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
         with Transaction("workdir") as txn:
             #pylint: disable=invalid-name
             with txn.open("testfile.txt", "w") as f:
-                f.write("This is changed content\n")
+                f.write(_NEW.decode())
         # Transaction is commited
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is changed content\n")
-        self.assertEqual(os.listdir("."), ["workdir"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _NEW)
+        self._assert_no_leftovers()
     def test_commit_rplus(self):
         """"
         Create test directory, create file in it
@@ -94,17 +227,14 @@ class FsTransTestCase(unittest.TestCase):
         Commit. See file changed
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
         with Transaction("workdir") as txn:
             #pylint: disable=invalid-name
             with txn.open("testfile.txt", "r+") as f:
                 f.seek(0, 0)
                 f.write("That")
         # Transaction is commited
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "That is test file content\n")
-        self.assertEqual(os.listdir("."), ["workdir"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _RPLUS)
+        self._assert_no_leftovers()
     def test_commit_a(self):
         """"
         create test directory, create file in it
@@ -113,16 +243,93 @@ class FsTransTestCase(unittest.TestCase):
         commit. see file changed
         see no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
         with Transaction("workdir") as txn:
             # pylint: disable=invalid-name
             with txn.open("testfile.txt", "a") as f:
-                f.write("This is changed content\n")
+                f.write(_NEW.decode())
         # transaction is commited
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is test file content\nThis is changed content\n")
-        self.assertEqual(os.listdir("."), ["workdir"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _APP)
+        self._assert_no_leftovers()
+    def test_commit_snapshot(self):
+        """
+        Create test directory, create file in it
+        Start transaction with leave_snapshot, modify file
+
+        Commit. See file changed and old version retained
+        in the snapshot
+        """
+        with Transaction("workdir", leave_snapshot="snapshot") as txn:
+            #pylint: disable=invalid-name
+            with txn.open("testfile.txt", "w") as f:
+                f.write(_NEW.decode())
+        self.assertEqual(getfile("workdir/testfile.txt"), _NEW)
+        self.assertEqual(getfile("snapshot/testfile.txt"), _ORIG)
+        self._assert_no_leftovers("snapshot")
+    def test_commit_no_exchange(self):
+        """
+        Commit with two renames, as done where renameat2 is not
+        available. See file changed and no temporary files left
+        """
+        with mock.patch("fstrans._exchange", return_value=False):
+            with Transaction("workdir") as txn:
+                #pylint: disable=invalid-name
+                with txn.open("testfile.txt", "w") as f:
+                    f.write(_NEW.decode())
+        self.assertEqual(getfile("workdir/testfile.txt"), _NEW)
+        self._assert_no_leftovers()
+    def test_commit_failure(self):
+        """
+        Make commit fail because snapshot name is occupied by
+        non-empty directory, with and without renameat2.
+
+        See committed tree unchanged, working tree discarded and
+        no temporary files left
+        """
+        os.mkdir("snapshot")
+        putfile("snapshot/oldfile.txt", _ORIG)
+        for patch in (nullcontext(),
+                      mock.patch("fstrans._exchange", return_value=False)):
+            with patch:
+                with self.assertRaises(OSError):
+                    with Transaction("workdir",
+                                     leave_snapshot="snapshot") as txn:
+                        #pylint: disable=invalid-name
+                        with txn.open("testfile.txt", "w") as f:
+                            f.write(_NEW.decode())
+            self.assertEqual(getfile("workdir/testfile.txt"), _ORIG)
+            self.assertEqual(set(os.listdir("snapshot")), {"oldfile.txt"})
+            self._assert_no_leftovers("snapshot")
+    def test_commit_background_cleanup(self):
+        """
+        Create test directory, create file in it
+        Start transaction with background_cleanup, modify file
+
+        Commit. See file changed and no temporary files left
+        after cleanup thread finishes
+        """
+        with Transaction("workdir", background_cleanup=True) as txn:
+            #pylint: disable=invalid-name
+            with txn.open("testfile.txt", "w") as f:
+                f.write(_NEW.decode())
+        self.assertEqual(getfile("workdir/testfile.txt"), _NEW)
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+        self._assert_no_leftovers()
+    def test_commit_a_newfile(self):
+        """"
+        create test directory
+        start transaction, create new file using open in append mode
+
+        commit. see file created
+        """
+        with Transaction("workdir") as txn:
+            # pylint: disable=invalid-name
+            with txn.open("newfile.txt", "a") as f:
+                f.write("This is new content\n")
+        self.assertEqual(getfile("workdir/newfile.txt"),
+                         b"This is new content\n")
+        self._assert_no_leftovers()
     def test_rollback(self):
         """
         Create test directory, create file in it
@@ -131,21 +338,15 @@ class FsTransTestCase(unittest.TestCase):
         Rollback, see file unchanged
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
-        try:
-            with Transaction("workdir") as txn:
-                # pylint: disable=invalid-name
-                with txn.open("testfile.txt", "w") as f:
-                    self.assertEqual(os.stat(f.fileno()).st_nlink, 1)
-                    f.write("This is changed content\n")
-                raise RuntimeError("Rollback transaction")
-        except RuntimeError:
-            pass
+        with suppress(RuntimeError), Transaction("workdir") as txn:
+            # pylint: disable=invalid-name
+            with txn.open("testfile.txt", "w") as f:
+                self.assertEqual(os.stat(f.fileno()).st_nlink, 1)
+                f.write(_NEW.decode())
+            raise RuntimeError("Rollback transaction")
         # Transaction is rolled back
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is test file content\n")
-        self.assertEqual(os.listdir("."), ["workdir"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _ORIG)
+        self._assert_no_leftovers()
     def test_rollback_rplus(self):
         """
         Create test directory, create file in it
@@ -154,20 +355,14 @@ class FsTransTestCase(unittest.TestCase):
         Rollback, see file unchanged
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
-        try:
-            with Transaction("workdir") as txn:
-                with txn.open("testfile.txt", "r+") as workfile:
-                    workfile.seek(0, 0)
-                    workfile.write("That")
-                raise RuntimeError("Rollback transaction")
-        except RuntimeError:
-            pass
+        with suppress(RuntimeError), Transaction("workdir") as txn:
+            with txn.open("testfile.txt", "r+") as workfile:
+                workfile.seek(0, 0)
+                workfile.write("That")
+            raise RuntimeError("Rollback transaction")
         # Transaction is rolled back
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is test file content\n")
-        self.assertEqual(os.listdir("."), ["workdir"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _ORIG)
+        self._assert_no_leftovers()
     def test_rollback_a(self):
         """
         Create test directory, create file in it
@@ -176,19 +371,13 @@ class FsTransTestCase(unittest.TestCase):
         Rollback, see file unchanged
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
-        try:
-            with Transaction("workdir") as txn:
-                with txn.open("testfile.txt", "a") as workfile:
-                    workfile.write("This is changed content\n")
-                raise RuntimeError("Rollback transaction")
-        except RuntimeError:
-            pass
+        with suppress(RuntimeError), Transaction("workdir") as txn:
+            with txn.open("testfile.txt", "a") as workfile:
+                workfile.write(_NEW.decode())
+            raise RuntimeError("Rollback transaction")
         # Transaction is rolled back
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is test file content\n")
-        self.assertEqual(os.listdir("."), ["workdir"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _ORIG)
+        self._assert_no_leftovers()
     def test_commit_putfile(self):
         """
         Create test directory, create file in it
@@ -197,16 +386,60 @@ class FsTransTestCase(unittest.TestCase):
         Commit. See file changed
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
-        putfile("newfile.txt", "This is updated file content\n")
-        fullpath = os.path.realpath("newfile.txt")
+        putfile("newfile.txt", _UPD)
+        fullpath = os.path.abspath("newfile.txt")
         with Transaction("workdir") as txn:
             txn.putfile("testfile.txt", fullpath)
         # transaction commited
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is updated file content\n")
-        self.assertEqual(sorted(os.listdir(".")), ["newfile.txt", "workdir"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _UPD)
+        self._assert_no_leftovers("newfile.txt")
+    def test_commit_putfile_move(self):
+        """
+        Create test directory, create file in it
+        Start transaction, replace file using putfile with move
+
+        Commit. See file changed and source file gone
+        """
+        putfile("newfile.txt", _UPD)
+        fullpath = os.path.abspath("newfile.txt")
+        with Transaction("workdir") as txn:
+            txn.putfile("testfile.txt", fullpath, move=True)
+        self.assertEqual(getfile("workdir/testfile.txt"), _UPD)
+        self._assert_no_leftovers()
+    def test_commit_putfile_move_exdev(self):
+        """
+        Create test directory, create file in it
+        Start transaction, replace file using putfile with move,
+        pretending source is on another filesystem
+
+        Commit. See file changed and source file gone
+        """
+        putfile("newfile.txt", _UPD)
+        fullpath = os.path.abspath("newfile.txt")
+        exdev = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        with Transaction("workdir") as txn:
+            with mock.patch("fstrans.os.replace",
+                            side_effect=exdev) as replace:
+                txn.putfile("testfile.txt", fullpath, move=True)
+            replace.assert_called_once()
+        self.assertEqual(getfile("workdir/testfile.txt"), _UPD)
+        self.assertFalse(os.path.exists(fullpath))
+        self._assert_no_leftovers()
+    def test_commit_putfile_no_ficlone(self):
+        """
+        Tests that putfile doesn't send FICLONE ioctl on systems
+        which don't have it, and still copies the file
+        """
+        putfile("newfile.txt", _UPD)
+        fullpath = os.path.abspath("newfile.txt")
+        with mock.patch("fstrans._FICLONE", None), \
+                mock.patch("fstrans.fcntl.ioctl") as ioctl:
+            with Transaction("workdir") as txn:
+                txn.putfile("testfile.txt", fullpath)
+            self.assertFalse(fstrans._can_reflink(".")) #pylint: disable=protected-access
+        ioctl.assert_not_called()
+        self.assertEqual(getfile("workdir/testfile.txt"), _UPD)
+        self._assert_no_leftovers("newfile.txt")
     def test_rollback_putfile(self):
         """
         Create test directory, create file in it
@@ -215,19 +448,13 @@ class FsTransTestCase(unittest.TestCase):
         Rollback, see file unchanged
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
-        putfile("newfile.txt", "This is updated file content\n")
-        fullpath = os.path.realpath("newfile.txt")
-        try:
-            with Transaction("workdir") as txn:
-                txn.putfile("testfile.txt", fullpath)
-                raise RuntimeError("Aborting transaction")
-        except RuntimeError:
-            pass
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is test file content\n")
-        self.assertEqual(sorted(os.listdir(".")), ["newfile.txt", "workdir"])
+        putfile("newfile.txt", _UPD)
+        fullpath = os.path.abspath("newfile.txt")
+        with suppress(RuntimeError), Transaction("workdir") as txn:
+            txn.putfile("testfile.txt", fullpath)
+            raise RuntimeError("Aborting transaction")
+        self.assertEqual(getfile("workdir/testfile.txt"), _ORIG)
+        self._assert_no_leftovers("newfile.txt")
     def test_commit_unlink(self):
         """
         Create test directory, create two files in it
@@ -236,16 +463,14 @@ class FsTransTestCase(unittest.TestCase):
         Commit, See only one file left
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
         putfile("workdir/testfile2.txt",
-                "This is second testfile content\n")
-        putfile("testfile2.txt", "This is file outside transaction tree\n")
+                b"This is second testfile content\n")
+        putfile("testfile2.txt", b"This is file outside transaction tree\n")
         with Transaction("workdir"):
             os.unlink("testfile2.txt")
         # commit transaction
-        self.assertEqual(sorted(os.listdir("workdir")), ["testfile.txt"])
-        self.assertEqual(sorted(os.listdir(".")), ["testfile2.txt", "workdir"])
+        self.assertEqual(set(os.listdir("workdir")), {"testfile.txt"})
+        self._assert_no_leftovers("testfile2.txt")
     def test_rollback_unlink(self):
         """
         Create test directory, create two files in it
@@ -254,20 +479,15 @@ class FsTransTestCase(unittest.TestCase):
         Commit, See only one file left
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
         putfile("workdir/testfile2.txt",
-                "This is second testfile content\n")
-        putfile("testfile2.txt", "This is file outside transaction tree\n")
-        try:
-            with Transaction("workdir"):
-                os.unlink("testfile2.txt")
-                raise RuntimeError("Abort transaction")
-        except RuntimeError:
-            pass
-        self.assertEqual(sorted(os.listdir("workdir")),
-                         ["testfile.txt", "testfile2.txt"])
-        self.assertEqual(sorted(os.listdir(".")), ["testfile2.txt", "workdir"])
+                b"This is second testfile content\n")
+        putfile("testfile2.txt", b"This is file outside transaction tree\n")
+        with suppress(RuntimeError), Transaction("workdir"):
+            os.unlink("testfile2.txt")
+            raise RuntimeError("Abort transaction")
+        self.assertEqual(set(os.listdir("workdir")),
+                         {"testfile.txt", "testfile2.txt"})
+        self._assert_no_leftovers("testfile2.txt")
 
     def test_commit_clone(self):
         """"
@@ -277,9 +497,7 @@ class FsTransTestCase(unittest.TestCase):
         Commit. See file changed
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
-        putfile("testfile.txt", "This is file outside transaction\n")
+        putfile("testfile.txt", _OUTSIDE)
         with Transaction("workdir") as txn:
             txn.clonefile("testfile.txt")
             with open("testfile.txt", "r+") as workfile:
@@ -287,12 +505,10 @@ class FsTransTestCase(unittest.TestCase):
                 workfile.write("That")
 
         # Transaction is commited
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "That is test file content\n")
-        self.assertEqual(getfile("testfile.txt"),
-                         "This is file outside transaction\n")
-        self.assertEqual(sorted(os.listdir(".")), ["testfile.txt", "workdir"])
-        self.assertEqual(sorted(os.listdir("workdir")), ["testfile.txt"])
+        self.assertEqual(getfile("workdir/testfile.txt"), _RPLUS)
+        self.assertEqual(getfile("testfile.txt"), _OUTSIDE)
+        self._assert_no_leftovers("testfile.txt")
+        self.assertEqual(set(os.listdir("workdir")), {"testfile.txt"})
     def test_rollback_clone(self):
         """"
         Create test directory, create file in it
@@ -301,24 +517,17 @@ class FsTransTestCase(unittest.TestCase):
         Rollback. See file unchanged
         See no temporary files left
         """
-        os.mkdir("workdir")
-        putfile("workdir/testfile.txt", "This is test file content\n")
-        putfile("testfile.txt", "This is file outside transaction\n")
-        try:
-            with Transaction("workdir") as txn:
-                txn.clonefile("testfile.txt")
-                with open("testfile.txt", "r+") as workfile:
-                    workfile.seek(0, 0)
-                    workfile.write("That")
-                raise RuntimeError("Abort transaction")
-        except RuntimeError:
-            pass
-        self.assertEqual(getfile("workdir/testfile.txt"),
-                         "This is test file content\n")
-        self.assertEqual(getfile("testfile.txt"),
-                         "This is file outside transaction\n")
-        self.assertEqual(sorted(os.listdir(".")), ["testfile.txt", "workdir"])
-        self.assertEqual(sorted(os.listdir("workdir")), ["testfile.txt"])
+        putfile("testfile.txt", _OUTSIDE)
+        with suppress(RuntimeError), Transaction("workdir") as txn:
+            txn.clonefile("testfile.txt")
+            with open("testfile.txt", "r+") as workfile:
+                workfile.seek(0, 0)
+                workfile.write("That")
+            raise RuntimeError("Abort transaction")
+        self.assertEqual(getfile("workdir/testfile.txt"), _ORIG)
+        self.assertEqual(getfile("testfile.txt"), _OUTSIDE)
+        self._assert_no_leftovers("testfile.txt")
+        self.assertEqual(set(os.listdir("workdir")), {"testfile.txt"})
     def test_clonetree(self):
         """
         Create some directory hierarchy start transaction and
@@ -326,16 +535,81 @@ class FsTransTestCase(unittest.TestCase):
 
         See if all files in the cloned tree has one link
         """
-        os.mkdir("workdir")
         os.mkdir("workdir/subdir")
-        putfile("workdir/subdir/file1", "file1 content\n")
-        putfile("workdir/subdir/file2", "file2 content\n")
+        putfile("workdir/subdir/file1", b"file1 content\n")
+        putfile("workdir/subdir/file2", b"file2 content\n")
         with Transaction("workdir") as txn:
             self.assertEqual(os.stat("subdir/file1").st_nlink, 2)
             self.assertEqual(os.stat("subdir/file1").st_nlink, 2)
             txn.clonetree('subdir')
             self.assertEqual(os.stat("subdir/file1").st_nlink, 1)
             self.assertEqual(os.stat("subdir/file1").st_nlink, 1)
+    def test_clone_keeps_stat(self):
+        """
+        Test that cloned files retain mode and modification time
+        of originals whether or not mode of fresh copy matches
+        """
+        putfile("workdir/private", b"private content\n")
+        putfile("workdir/public", b"public content\n")
+        os.chmod("workdir/private", 0o600)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod("workdir/public", 0o666 & ~umask)
+        for name in ("private", "public"):
+            os.utime("workdir/" + name, ns=(1000000000, 2000000000))
+        with Transaction("workdir") as txn:
+            txn.clonefile("private")
+            txn.clonefile("public")
+            for name in ("private", "public"):
+                newstat = os.stat(name)
+                oldstat = os.stat("../workdir/" + name)
+                self.assertEqual(newstat.st_nlink, 1)
+                self.assertEqual(newstat.st_mode, oldstat.st_mode)
+                self.assertEqual(newstat.st_mtime_ns, 2000000000)
+    def test_clone_keeps_xattr(self):
+        """
+        Test that cloned files retain extended attributes of originals
+        """
+        try:
+            os.setxattr("workdir/testfile.txt", "user.tag", b"value")
+        except (AttributeError, OSError):
+            self.skipTest("Extended attributes are not supported")
+        with Transaction("workdir") as txn:
+            txn.clonefile("testfile.txt")
+            self.assertEqual(os.stat("testfile.txt").st_nlink, 1)
+            self.assertEqual(os.getxattr("testfile.txt", "user.tag"),
+                             b"value")
+    def test_clonetree_file(self):
+        """
+        Test clonetree on a regular file, which should be cloned,
+        and on nonexistent path, which should be ignored
+        """
+        with Transaction("workdir") as txn:
+            txn.clonetree("testfile.txt")
+            self.assertEqual(os.stat("testfile.txt").st_nlink, 1)
+            self.assertEqual(getfile("testfile.txt"), _ORIG)
+            txn.clonetree("nonexistent")
+    def test_clonetree_parallel(self):
+        """
+        Create directory hierarchy big enough to be cloned in parallel,
+        start transaction and clone it.
+
+        See if all files in the cloned tree has one link and
+        original files are not affected by modification
+        """
+        os.makedirs("workdir/subdir/deeper")
+        for i in range(CLONE_THRESHOLD):
+            putfile("workdir/subdir/file%d" % i, b"file content\n")
+            putfile("workdir/subdir/deeper/file%d" % i, b"file content\n")
+        with Transaction("workdir") as txn:
+            txn.clonetree('subdir')
+            for i in range(CLONE_THRESHOLD):
+                self.assertEqual(os.stat("subdir/file%d" % i).st_nlink, 1)
+                self.assertEqual(os.stat("subdir/deeper/file%d" % i).st_nlink,
+                                 1)
+                putfile("subdir/deeper/file%d" % i, b"changed content\n")
+            self.assertEqual(getfile("../workdir/subdir/deeper/file0"),
+                             b"file content\n")
     def test_root(self):
         """
         Test if root property outside  transaction context points to
@@ -344,8 +618,7 @@ class FsTransTestCase(unittest.TestCase):
         Check if entering transaction context changed directory
         into root of temporary tree and leaving restores it
         """
-        os.mkdir("workdir")
-        parent = os.getcwd()
+        parent = self.root_abs
         txn = Transaction("workdir")
         self.assertEqual(txn.root, os.path.join(parent, "workdir"))
         with txn:
@@ -358,7 +631,6 @@ class FsTransTestCase(unittest.TestCase):
         Test internal method check_opened which raises a runtime
         error when called in untexpeded state
         """
-        os.mkdir("workdir")
         txn = Transaction("workdir")
         with self.assertRaises(RuntimeError):
             txn.check_opened()
@@ -373,11 +645,10 @@ class FsTransTestCase(unittest.TestCase):
         Test check_inside method, which checks whether path is inside
         a transaction, and raises ValueError if not.
         """
-        os.mkdir("workdir")
         os.mkdir("workdir/subdir")
         os.mkdir("outsidedir")
         txn = Transaction("workdir")
-        parent = os.getcwd()
+        parent = self.root_abs
         outsider = os.path.realpath("outsidedir")
         with self.assertRaises(ValueError):
             txn.check_inside(parent)
@@ -399,6 +670,191 @@ class FsTransTestCase(unittest.TestCase):
                 txn.check_inside(outsider)
             with self.assertRaises(ValueError):
                 txn.check_inside(os.path.join(parent, "workdir"))
+    def _check_copy_tree(self):
+        """
+        Checks that copy_tree recreates directory hierarchy with
+        same modes and hardlinks files and symlinks
+        """
+        os.makedirs("olddir/subdir/deeper")
+        os.chmod("olddir/subdir", 0o750)
+        putfile("olddir/file1", b"file1 content\n")
+        putfile("olddir/subdir/deeper/file2", b"file2 content\n")
+        os.symlink("file1", "olddir/link")
+        os.symlink("subdir", "olddir/dirlink")
+        copy_tree("olddir", "newdir")
+        self.assertEqual(set(os.listdir("newdir")),
+                         {"file1", "link", "dirlink", "subdir"})
+        self.assertEqual(os.readlink("newdir/dirlink"), "subdir")
+        self.assertEqual(os.stat("newdir/subdir").st_mode,
+                         os.stat("olddir/subdir").st_mode)
+        self.assertTrue(os.path.samefile("newdir/file1", "olddir/file1"))
+        self.assertTrue(os.path.samefile("newdir/subdir/deeper/file2",
+                                         "olddir/subdir/deeper/file2"))
+        self.assertTrue(os.path.islink("newdir/link"))
+        self.assertEqual(os.readlink("newdir/link"), "file1")
+        with self.assertRaises(FileExistsError):
+            copy_tree("olddir", "newdir")
+    def test_copy_tree(self):
+        """
+        Test copy_tree function with C extension, if it is built
+        """
+        self._check_copy_tree()
+    def test_copy_tree_python(self):
+        """
+        Test copy_tree function with pure Python hardlinking loop
+        """
+        #pylint: disable=protected-access
+        with mock.patch("fstrans._link_names", fstrans._py_link_names):
+            self._check_copy_tree()
+    def test_copy_tree_reflink_supported(self):
+        """
+        Test copy_tree with reflink option on filesystem which
+        supports it (emulated). Regular files should be independent
+        copies with same content, mode and times, symlinks hardlinked.
+        """
+        os.makedirs("olddir/subdir")
+        putfile("olddir/subdir/file1", b"file1 content\n")
+        os.chmod("olddir/subdir/file1", 0o640)
+        os.utime("olddir/subdir/file1", ns=(1000000000, 2000000000))
+        os.symlink("file1", "olddir/subdir/link")
+        with mock.patch("fstrans.fcntl.ioctl", fake_ficlone), \
+             mock.patch.dict("fstrans._REFLINK_SUPPORT", clear=True):
+            copy_tree("olddir", "newdir", reflink=True)
+        self.assertEqual(getfile("newdir/subdir/file1"), b"file1 content\n")
+        oldstat = os.stat("olddir/subdir/file1")
+        newstat = os.stat("newdir/subdir/file1")
+        self.assertNotEqual(newstat.st_ino, oldstat.st_ino)
+        self.assertEqual(newstat.st_nlink, 1)
+        self.assertEqual(newstat.st_mode, oldstat.st_mode)
+        self.assertEqual(newstat.st_mtime_ns, 2000000000)
+        self.assertEqual(os.lstat("newdir/subdir/link").st_ino,
+                         os.lstat("olddir/subdir/link").st_ino)
+    def test_commit_reflink_keeps_metadata(self):
+        """
+        Tests that committing transaction with reflink option keeps
+        extended attributes and owner of untouched files
+        """
+        try:
+            os.setxattr("workdir/testfile.txt", "user.tag", b"value")
+        except (AttributeError, OSError):
+            self.skipTest("Extended attributes are not supported")
+        owner = (12345, 12345) if os.geteuid() == 0 else (os.getuid(),
+                                                         os.getgid())
+        os.chown("workdir/testfile.txt", *owner)
+        with mock.patch("fstrans.fcntl.ioctl", fake_ficlone), \
+             mock.patch.dict("fstrans._REFLINK_SUPPORT", clear=True):
+            with Transaction("workdir", reflink=True):
+                self.assertEqual(os.stat("testfile.txt").st_nlink, 1)
+        self.assertEqual(os.getxattr("workdir/testfile.txt", "user.tag"),
+                         b"value")
+        st = os.stat("workdir/testfile.txt")
+        self.assertEqual((st.st_uid, st.st_gid), owner)
+        self.assertEqual(getfile("workdir/testfile.txt"), _ORIG)
+    def test_copy_tree_reflink_xattr_fallback(self):
+        """
+        Test copy_tree with reflink option when extended attributes
+        cannot be copied to reflinked file. It should be hardlinked.
+        """
+        os.mkdir("olddir")
+        putfile("olddir/file1", b"file1 content\n")
+        try:
+            os.setxattr("olddir/file1", "user.tag", b"value")
+        except (AttributeError, OSError):
+            self.skipTest("Extended attributes are not supported")
+        eperm = OSError(errno.EPERM, os.strerror(errno.EPERM))
+        with mock.patch("fstrans.fcntl.ioctl", fake_ficlone), \
+             mock.patch("fstrans._can_reflink", return_value=True), \
+             mock.patch("fstrans.os.setxattr", side_effect=eperm):
+            copy_tree("olddir", "newdir", reflink=True)
+        self.assertTrue(os.path.samefile("newdir/file1", "olddir/file1"))
+    def test_copy_tree_reflink_fallback(self):
+        """
+        Test copy_tree with reflink option when some file cannot be
+        reflinked, although filesystem supports it. Such file should
+        be hardlinked.
+        """
+        os.mkdir("olddir")
+        putfile("olddir/file1", b"file1 content\n")
+        putfile("olddir/nocow", b"nocow content\n")
+        def ficlone(fd, request, arg): #pylint: disable=invalid-name
+            if os.readlink("/proc/self/fd/%d" % fd).endswith("/nocow"):
+                raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+            return fake_ficlone(fd, request, arg)
+        with mock.patch("fstrans.fcntl.ioctl", ficlone), \
+             mock.patch("fstrans._can_reflink", return_value=True):
+            copy_tree("olddir", "newdir", reflink=True)
+        self.assertEqual(os.stat("newdir/file1").st_nlink, 1)
+        self.assertTrue(os.path.samefile("newdir/nocow", "olddir/nocow"))
+    def test_lock_copy_failure(self):
+        """
+        Tests that if copying of tree fails, working tree is removed,
+        so tree is not left locked
+        """
+        enospc = OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        with mock.patch("fstrans.fcntl.ioctl", side_effect=enospc), \
+             mock.patch("fstrans._can_reflink", return_value=True):
+            with self.assertRaises(OSError):
+                with Transaction("workdir", reflink=True):
+                    pass
+        self._assert_no_leftovers()
+        with Transaction("workdir", timeout=0.3) as txn:
+            self.assertTrue(txn.opened)
+    def test_can_reflink_cached(self):
+        """
+        Test that filesystem is probed for reflink support only once
+        """
+        with mock.patch.dict("fstrans._REFLINK_SUPPORT", clear=True), \
+             mock.patch("fstrans.TemporaryFile",
+                        wraps=tempfile.TemporaryFile) as tmpfile:
+            #pylint: disable=protected-access
+            first = fstrans._can_reflink("workdir")
+            self.assertEqual(fstrans._can_reflink("."), first)
+            self.assertEqual(tmpfile.call_count, 2)
+    def test_copy_tree_parallel(self):
+        """
+        Test copy_tree on tree wide enough to be copied by thread pool
+        """
+        for i in range(PARALLEL_THRESHOLD * 2):
+            os.makedirs("olddir/dir%d/subdir" % i)
+            putfile("olddir/dir%d/subdir/file" % i, b"file content\n")
+        for i in range(100):
+            putfile("olddir/file%d" % i, b"file content\n")
+        copy_tree("olddir", "newdir")
+        for i in range(PARALLEL_THRESHOLD * 2):
+            self.assertTrue(os.path.samefile("newdir/dir%d/subdir/file" % i,
+                                             "olddir/dir%d/subdir/file" % i))
+        for i in range(100):
+            self.assertTrue(os.path.samefile("newdir/file%d" % i,
+                                             "olddir/file%d" % i))
+    def test_copy_tree_reflink(self):
+        """
+        Test copy_tree with reflink option. Files should be either
+        independent copies with same content and mode, or hardlinks
+        if filesystem doesn't support reflinks.
+        """
+        os.makedirs("olddir/subdir")
+        putfile("olddir/subdir/file1", b"file1 content\n")
+        os.chmod("olddir/subdir/file1", 0o640)
+        os.symlink("file1", "olddir/subdir/link")
+        copy_tree("olddir", "newdir", reflink=True)
+        self.assertEqual(getfile("newdir/subdir/file1"), b"file1 content\n")
+        oldstat = os.stat("olddir/subdir/file1")
+        newstat = os.stat("newdir/subdir/file1")
+        self.assertEqual(newstat.st_mode, oldstat.st_mode)
+        self.assertEqual(newstat.st_mtime_ns, oldstat.st_mtime_ns)
+        if newstat.st_ino != oldstat.st_ino:
+            self.assertEqual(newstat.st_nlink, 1)
+        self.assertTrue(os.path.islink("newdir/subdir/link"))
+
+def load_tests(loader, tests, pattern): #pylint: disable=unused-argument
+    """
+    Runs tests in parallel forked processes if concurrencytest
+    module is available. Each test has its own playground directory
+    and process has its own current directory, so they don't interfere
+    """
+    if ConcurrentTestSuite is None:
+        return tests
+    return ConcurrentTestSuite(tests, fork_for_tests(os.cpu_count() or 1))
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,13 +14,19 @@ setuptools.setup(
     long_description_content_type='text/markdown',
     url='https://github.com/vbwagner/fstrans',
     packages=setuptools.find_packages(),
+    ext_modules=[
+        # Optional fast path for copy_tree, pure Python fallback is used
+        # if it cannot be built
+        setuptools.Extension('fstrans._linktree', ['fstrans/_linktree.c'],
+                             optional=True),
+    ],
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Operating System :: Unix',
         'Operating System :: POSIX'
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     test_suite="fstrans.tests.testfstrans",
     include_package_data=True,
 )   